@@ -4,8 +4,20 @@
 
 import streamlit as st
 import pandas as pd
-from io import BytesIO
-from openpyxl import Workbook
+import os
+import json
+import hashlib
+import hmac
+import secrets
+import tempfile
+import threading
+import uuid
+import zipfile
+import cProfile
+import pstats
+from datetime import datetime
+from io import BytesIO, StringIO
+from openpyxl import Workbook, load_workbook
 from openpyxl.styles import PatternFill, Font, Border, Side
 import numpy as np
 
@@ -18,6 +30,23 @@ import numpy as np
 GOOGLE_SHEET_ID = "1PpiMQingHf4llA03BiPIuPJPIZqul4grRU_emWDEK1o"
 TEMPLATE_SHEET_NAME = "template_estoque"  # nome da aba onde está o estoque
 
+# Colunas aceitas na planilha de vendas (já normalizadas)
+COLUNAS_CODIGO_VENDAS = ["codigo", "código", "cod"]
+COLUNAS_QTD_VENDAS = ["quantidade", "qtd", "qtde"]
+
+# Nº de linhas lidas por vez no modo "em blocos" (arquivos de vendas muito grandes)
+TAMANHO_BLOCO_VENDAS = 50_000
+
+# 🔬 PERFIL DE DESEMPENHO (opcional, desligado por padrão)
+# Liga com a variável de ambiente PERFIL_PLANEJAMENTO=1, ou abrindo o app com
+# ?perfil=<PERFIL_TOKEN> (só funciona se PERFIL_TOKEN estiver configurado).
+# Cada rodada perfilada oferece um .zip para download com o perfil (cProfile) +
+# um pacote anonimizado (códigos/nomes com HMAC de chave aleatória) para replay local:
+#     unzip perfil-<...>.zip -d perfis/
+#     REPLAY_PERFIL=perfis/<pasta> streamlit run app_improved.py
+PERFIL_TOKEN = os.environ.get("PERFIL_TOKEN", "")
+REPLAY_PERFIL = os.environ.get("REPLAY_PERFIL", "")
+
 st.set_page_config(
     page_title="Pure & Posh Baby - Vendas → Estoque → Produção",
     page_icon="👑",
@@ -87,6 +116,86 @@ def normalizar_colunas(df):
     )
     return df
 
+def encontrar_coluna(colunas, candidatas):
+    """Retorna a primeira coluna candidata presente em `colunas` (ou None)."""
+    for c in candidatas:
+        if c in colunas:
+            return c
+    return None
+
+def somar_bloco_vendas(acumulado, codigos, quantidades):
+    """
+    Soma um bloco de linhas (código, quantidade) no acumulador código -> qtd.
+    Mantém o tipo do to_numeric (int quando todas as quantidades são inteiras),
+    igual ao groupby do modo normal.
+    """
+    qtd = pd.to_numeric(pd.Series(quantidades, dtype=object), errors="coerce").fillna(0)
+    bloco = qtd.groupby(pd.Series(codigos, dtype=object), sort=False).sum()
+    for cod, q in bloco.items():
+        acumulado[cod] = acumulado.get(cod, 0) + q
+
+def normalizar_cabecalho(cabecalho):
+    """Normaliza a linha de cabeçalho lida pelo openpyxl (mesma regra de normalizar_colunas)."""
+    return list(normalizar_colunas(
+        pd.DataFrame(columns=["" if c is None else str(c) for c in cabecalho])
+    ).columns)
+
+def consolidar_vendas_em_blocos_sem_cache(file, tamanho_bloco=TAMANHO_BLOCO_VENDAS):
+    """
+    Lê a planilha de vendas em blocos de linhas (openpyxl em modo read_only)
+    e vai somando a quantidade por código num dicionário acumulador.
+
+    - Evita montar o DataFrame com todas as linhas/colunas: as linhas ficam
+      limitadas a 1 bloco + 1 entrada por código distinto.
+    - Não é memória constante: o openpyxl ainda carrega a tabela inteira de
+      textos compartilhados (sharedStrings) da planilha, que cresce com nomes,
+      endereços, nº de pedido etc., e o arquivo enviado fica todo em memória.
+    - Usa apenas a primeira aba da planilha.
+    - Retorna o mesmo DataFrame (codigo, quantidade) do groupby tradicional,
+      ou None se não encontrar as colunas de código/quantidade.
+    """
+    if hasattr(file, "seek"):
+        file.seek(0)
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        linhas = wb.worksheets[0].iter_rows(values_only=True)
+        cabecalho = next(linhas, None)
+        if cabecalho is None:
+            return None
+
+        colunas = normalizar_cabecalho(cabecalho)
+        col_codigo = encontrar_coluna(colunas, COLUNAS_CODIGO_VENDAS)
+        col_qtd = encontrar_coluna(colunas, COLUNAS_QTD_VENDAS)
+        if not col_codigo or not col_qtd:
+            return None
+        idx_codigo = colunas.index(col_codigo)
+        idx_qtd = colunas.index(col_qtd)
+
+        acumulado = {}
+        codigos, quantidades = [], []
+        for linha in linhas:
+            codigos.append(linha[idx_codigo] if idx_codigo < len(linha) else None)
+            quantidades.append(linha[idx_qtd] if idx_qtd < len(linha) else None)
+            if len(codigos) >= tamanho_bloco:
+                somar_bloco_vendas(acumulado, codigos, quantidades)
+                codigos, quantidades = [], []
+        if codigos:
+            somar_bloco_vendas(acumulado, codigos, quantidades)
+    finally:
+        wb.close()
+
+    df = pd.DataFrame(
+        {"codigo": list(acumulado.keys()), "quantidade": list(acumulado.values())},
+        columns=["codigo", "quantidade"],
+    )
+    # Mesmo formato/ordem do groupby do modo normal (barato: 1 linha por código)
+    return df.groupby("codigo", as_index=False)["quantidade"].sum()
+
+@st.cache_data
+def consolidar_vendas_em_blocos(file, tamanho_bloco=TAMANHO_BLOCO_VENDAS):
+    """Versão com cache de consolidar_vendas_em_blocos_sem_cache (1 linha por código)."""
+    return consolidar_vendas_em_blocos_sem_cache(file, tamanho_bloco)
+
 def bool_from_any(x):
     if pd.isna(x):
         return False
@@ -251,6 +360,182 @@ def gerar_excel_simples(df, sheet_name="Relatorio"):
     output.seek(0)
     return output
 
+# ==============================================================================
+# PERFIL DE DESEMPENHO + PACOTE DE REPLAY ANONIMIZADO
+# ==============================================================================
+
+def anonimizar_codigo(x, chave):
+    """
+    Troca um valor por um HMAC-SHA256 com a `chave` do pacote (mesmo valor →
+    mesmo token dentro do pacote, irreversível sem a chave).
+    Números inteiros (101 / 101.0) viram o mesmo token, mas "101" (texto) não,
+    para que os cruzamentos código × estoque se comportem igual ao original.
+    """
+    if pd.isna(x):
+        return x
+    if isinstance(x, (int, float, np.integer, np.floating)) and not isinstance(x, bool):
+        f = float(x)
+        msg = f"n:{int(f)}" if f.is_integer() else f"n:{f!r}"
+    else:
+        msg = f"s:{x}"
+    return "h" + hmac.new(chave, msg.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+def anonimizar_texto(x, chave):
+    """Versão para colunas lidas com str(...).strip() (semi/gola/bordado)."""
+    s = str(x).strip()
+    return anonimizar_codigo(s, chave) if s else x
+
+def anonimizar_celula(v, chave):
+    """
+    Troca uma célula qualquer da planilha de vendas por um valor do mesmo
+    tipo e tamanho derivado do HMAC (texto → texto, inteiro → inteiro com
+    o mesmo nº de dígitos, decimal → decimal entre 0 e |v|). Datas, booleanos
+    e células vazias ficam como estão. Mantém o custo de leitura no replay.
+    """
+    if v is None or isinstance(v, bool):
+        return v
+    if isinstance(v, (str, int, float)):
+        digest = hmac.new(chave, f"{type(v).__name__}:{v}".encode("utf-8"),
+                          hashlib.sha256).hexdigest()
+        if isinstance(v, str):
+            return (digest * (len(v) // len(digest) + 1))[:len(v)]
+        if isinstance(v, int):
+            return int(digest, 16) % (10 ** len(str(abs(v))))
+        return abs(v) * int(digest[:8], 16) / 0xFFFFFFFF
+    return v
+
+def anonimizar_estoque(df_est, chave):
+    """
+    Copia o template_estoque trocando códigos, nomes e demais textos por HMAC.
+    Mantém linhas, colunas, kits, quantidades e estoque_atual.
+    """
+    df = df_est.copy()
+    for col in df.columns:
+        if col in ["estoque_atual", "eh_kit", "quantidades"]:
+            continue
+        if col == "componentes":
+            df[col] = df[col].apply(
+                lambda t: ", ".join(anonimizar_texto(c, chave) for c in split_list(t))
+            )
+        elif col in ["semi_codigo", "gola_codigo", "bordado_codigo"]:
+            df[col] = df[col].apply(lambda x: anonimizar_texto(x, chave))
+        else:
+            df[col] = df[col].apply(lambda x: anonimizar_codigo(x, chave))
+    return df
+
+def anonimizar_vendas(file, destino, chave):
+    """
+    Copia a 1ª aba da planilha de vendas para `destino`, linha a linha
+    (openpyxl read_only → write_only). Mantém o cabeçalho e a quantidade,
+    troca o código por HMAC e as demais colunas (comprador, CPF, telefone...)
+    por valores de mesmo tipo/tamanho (anonimizar_celula). Retorna (linhas, colunas).
+    """
+    if hasattr(file, "seek"):
+        file.seek(0)
+    wb_in = load_workbook(file, read_only=True, data_only=True)
+    wb_out = Workbook(write_only=True)
+    ws_out = wb_out.create_sheet(title="vendas")
+    n_linhas, n_colunas = 0, 0
+    try:
+        linhas = wb_in.worksheets[0].iter_rows(values_only=True)
+        cabecalho = next(linhas, None)
+        if cabecalho is not None:
+            n_colunas = len(cabecalho)
+            ws_out.append(list(cabecalho))
+            colunas = normalizar_cabecalho(cabecalho)
+            col_codigo = encontrar_coluna(colunas, COLUNAS_CODIGO_VENDAS)
+            col_qtd = encontrar_coluna(colunas, COLUNAS_QTD_VENDAS)
+            idx_codigo = colunas.index(col_codigo) if col_codigo else -1
+            idx_qtd = colunas.index(col_qtd) if col_qtd else -1
+            for linha in linhas:
+                ws_out.append([
+                    v if i == idx_qtd
+                    else anonimizar_codigo(v, chave) if i == idx_codigo
+                    else anonimizar_celula(v, chave)
+                    for i, v in enumerate(linha)
+                ])
+                n_linhas += 1
+    finally:
+        wb_in.close()
+    wb_out.save(destino)
+    return n_linhas, n_colunas
+
+def salvar_perfil(perfil, destino, nome="perfil"):
+    """Salva o cProfile em <nome>.prof (binário) e <nome>.txt (top 40 por tempo acumulado)."""
+    perfil.dump_stats(os.path.join(destino, f"{nome}.prof"))
+    texto = StringIO()
+    pstats.Stats(perfil, stream=texto).sort_stats("cumulative").print_stats(40)
+    with open(os.path.join(destino, f"{nome}.txt"), "w", encoding="utf-8") as f:
+        f.write(texto.getvalue())
+
+def gerar_pacote_perfil(perfil, df_est, colunas_adicionadas, file_vendas, modo_blocos, insumos):
+    """
+    Monta o .zip com perfil.prof/.txt, estoque.xlsx, vendas.xlsx e meta.json
+    anonimizados. A chave do HMAC é aleatória por pacote e fica só em memória.
+
+    O estoque sai como foi lido (sem as colunas opcionais que o app completou
+    com ""), para o replay completar do mesmo jeito. `insumos` guarda o nº de
+    semis/golas/bordados da rodada original, conferido no replay.
+    Retorna (nome_do_zip, bytes).
+    """
+    pasta = f"perfil-{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+    chave = secrets.token_bytes(32)
+    output = BytesIO()
+    with tempfile.TemporaryDirectory() as tmp:
+        salvar_perfil(perfil, tmp)
+        anonimizar_estoque(df_est.drop(columns=colunas_adicionadas), chave).to_excel(
+            os.path.join(tmp, "estoque.xlsx"), sheet_name=TEMPLATE_SHEET_NAME, index=False
+        )
+        linhas_vendas, colunas_vendas = anonimizar_vendas(
+            file_vendas, os.path.join(tmp, "vendas.xlsx"), chave
+        )
+        meta = {
+            "criado_em": datetime.now().isoformat(timespec="seconds"),
+            "modo_blocos": bool(modo_blocos),
+            "estoque": {"linhas": int(df_est.shape[0]), "colunas": int(df_est.shape[1])},
+            "colunas_opcionais_adicionadas": list(colunas_adicionadas),
+            "vendas": {"linhas": linhas_vendas, "colunas": colunas_vendas},
+            "insumos": insumos,
+        }
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zf:
+            for arquivo in sorted(os.listdir(tmp)):
+                zf.write(os.path.join(tmp, arquivo), arcname=f"{pasta}/{arquivo}")
+    return f"{pasta}.zip", output.getvalue()
+
+@st.cache_resource
+def trava_perfil():
+    """
+    Trava do processo inteiro (compartilhada entre sessões): o cProfile só
+    aceita um perfil ativo por processo (no Python 3.12+ usa sys.monitoring).
+    """
+    return threading.Lock()
+
+def iniciar_perfil():
+    """Liga o cProfile se nenhuma outra sessão estiver perfilando; senão retorna None."""
+    trava = trava_perfil()
+    if not trava.acquire(blocking=False):
+        return None
+    perfil = cProfile.Profile()
+    try:
+        perfil.enable()
+    except ValueError:
+        # Outra ferramenta de profiling já está ativa no processo
+        trava.release()
+        return None
+    return perfil
+
+def parar_perfil(perfil):
+    perfil.disable()
+    trava_perfil().release()
+
+perfil_ativo = bool(REPLAY_PERFIL) or bool_from_any(os.environ.get("PERFIL_PLANEJAMENTO")) \
+    or (bool(PERFIL_TOKEN)
+        and hmac.compare_digest(st.query_params.get("perfil", "").encode("utf-8"),
+                                PERFIL_TOKEN.encode("utf-8")))
+
 # ==============================================================================
 # 1. CARREGAR TEMPLATE_ESTOQUE DO GOOGLE (SOMENTE LEITURA)
 # ==============================================================================
@@ -294,9 +579,15 @@ with col_a:
         st.session_state["template_carregado"] = False
         st.rerun()
 
+origem_template = f"do pacote de replay `{REPLAY_PERFIL}`" if REPLAY_PERFIL else "do Google Sheets"
+
 if not st.session_state["template_carregado"]:
     try:
-        df_est = load_template_from_google(GOOGLE_SHEET_ID, TEMPLATE_SHEET_NAME)
+        if REPLAY_PERFIL:
+            df_est = load_excel(os.path.join(REPLAY_PERFIL, "estoque.xlsx"),
+                                sheet_name=TEMPLATE_SHEET_NAME)
+        else:
+            df_est = load_template_from_google(GOOGLE_SHEET_ID, TEMPLATE_SHEET_NAME)
         df_est = normalizar_colunas(df_est)
 
         colunas_obrigatorias = ["codigo", "nome", "categoria", "estoque_atual"]
@@ -310,12 +601,15 @@ if not st.session_state["template_carregado"]:
             )
         else:
             # Garante colunas opcionais
+            colunas_adicionadas = []
             for col in ["eh_kit", "componentes", "quantidades",
                         "semi_codigo", "gola_codigo", "bordado_codigo"]:
                 if col not in df_est.columns:
                     df_est[col] = ""
+                    colunas_adicionadas.append(col)
 
             st.session_state["df_estoque"] = df_est
+            st.session_state["colunas_opcionais_adicionadas"] = colunas_adicionadas
             st.session_state["template_carregado"] = True
 
             total_itens = len(df_est)
@@ -323,13 +617,13 @@ if not st.session_state["template_carregado"]:
             total_mapeados = df_est["semi_codigo"].astype(str).str.strip().ne("").sum()
 
             st.success(
-                f"✅ template_estoque lido do Google Sheets com **{total_itens} itens**, "
+                f"✅ template_estoque lido {origem_template} com **{total_itens} itens**, "
                 f"**{total_kits} kits** e **{total_mapeados} produtos** mapeados em semi/gola/bordado."
             )
 
             st.dataframe(df_est.head(20))
     except Exception as e:
-        st.error(f"Erro ao ler template_estoque do Google Sheets: {e}")
+        st.error(f"Erro ao ler template_estoque {origem_template}: {e}")
 
 # ==============================================================================
 # 2. PROCESSAR VENDAS DO DIA
@@ -353,42 +647,85 @@ else:
             """
         )
 
-    uploaded_vendas = st.file_uploader(
-        "📂 Envie a planilha de vendas do dia",
-        type=["xlsx"],
-        key="vendas_file",
+    meta_replay = {}
+    if REPLAY_PERFIL:
+        # Reexecução local de um pacote anonimizado: ignora o upload
+        uploaded_vendas = os.path.join(REPLAY_PERFIL, "vendas.xlsx")
+        try:
+            with open(os.path.join(REPLAY_PERFIL, "meta.json"), encoding="utf-8") as f:
+                meta_replay = json.load(f)
+            st.info(f"🔁 Modo replay: usando o pacote anonimizado `{REPLAY_PERFIL}`.")
+        except (OSError, ValueError) as e:
+            st.error(f"Erro ao ler o meta.json do pacote de replay `{REPLAY_PERFIL}`: {e}")
+            uploaded_vendas = None
+    else:
+        uploaded_vendas = st.file_uploader(
+            "📂 Envie a planilha de vendas do dia",
+            type=["xlsx"],
+            key="vendas_file",
+        )
+
+    modo_blocos = st.checkbox(
+        "🧱 Arquivo muito grande? Processar em blocos (usa menos memória)",
+        value=meta_replay.get("modo_blocos", False),
+        help=(
+            "Lê a planilha em blocos de linhas e vai somando por código, sem carregar "
+            "a planilha inteira num DataFrame. Reduz bastante o pico de memória, mas "
+            "o arquivo enviado e os textos da planilha ainda ficam em memória. "
+            "Usa apenas a primeira aba."
+        ),
     )
 
     if uploaded_vendas:
+        # Perfil só na 1ª rodada de cada arquivo (o Streamlit reexecuta o script
+        # a cada clique, e os reruns usam cache)
+        perfil = None
+        insumos_perfil = {}
+        assinatura_perfil = (getattr(uploaded_vendas, "name", uploaded_vendas),
+                             getattr(uploaded_vendas, "size", None), modo_blocos)
         try:
-            df_vendas = load_excel(uploaded_vendas)
-            df_vendas = normalizar_colunas(df_vendas)
-
-            # Descobrir colunas de código e quantidade
-            col_codigo = None
-            for c in ["codigo", "código", "cod"]:
-                if c in df_vendas.columns:
-                    col_codigo = c
-                    break
-
-            col_qtd = None
-            for c in ["quantidade", "qtd", "qtde"]:
-                if c in df_vendas.columns:
-                    col_qtd = c
-                    break
-
-            if not col_codigo or not col_qtd:
+            if perfil_ativo and st.session_state.get("perfil_assinatura") != assinatura_perfil:
+                perfil = iniciar_perfil()
+                if perfil is None:
+                    st.caption("🔬 Outra sessão já está sendo perfilada; esta rodada segue sem perfil.")
+                else:
+                    st.session_state["perfil_assinatura"] = assinatura_perfil
+
+            # Com perfil ligado, lê sem cache para a ingestão entrar no perfil
+            if modo_blocos:
+                if perfil is not None:
+                    df_vendas = consolidar_vendas_em_blocos_sem_cache(uploaded_vendas)
+                else:
+                    df_vendas = consolidar_vendas_em_blocos(uploaded_vendas)
+            else:
+                if perfil is not None:
+                    if hasattr(uploaded_vendas, "seek"):
+                        uploaded_vendas.seek(0)
+                    df_vendas = pd.read_excel(uploaded_vendas, sheet_name=0)
+                else:
+                    df_vendas = load_excel(uploaded_vendas, sheet_name=0)
+                df_vendas = normalizar_colunas(df_vendas)
+
+                # Descobrir colunas de código e quantidade
+                col_codigo = encontrar_coluna(df_vendas.columns, COLUNAS_CODIGO_VENDAS)
+                col_qtd = encontrar_coluna(df_vendas.columns, COLUNAS_QTD_VENDAS)
+
+                if not col_codigo or not col_qtd:
+                    df_vendas = None
+                else:
+                    df_vendas = df_vendas[[col_codigo, col_qtd]].rename(
+                        columns={col_codigo: "codigo", col_qtd: "quantidade"}
+                    )
+                    df_vendas["quantidade"] = pd.to_numeric(df_vendas["quantidade"], errors="coerce").fillna(0)
+                    df_vendas = df_vendas.groupby("codigo", as_index=False)["quantidade"].sum()
+
+            if df_vendas is None:
                 st.error(
                     "❌ A planilha de vendas precisa ter uma coluna de **código** "
                     "(`codigo`, `código` ou `cod`) e uma de **quantidade** "
                     "(`quantidade`, `qtd` ou `qtde`)."
                 )
             else:
-                df_vendas = df_vendas[[col_codigo, col_qtd]].rename(
-                    columns={col_codigo: "codigo", col_qtd: "quantidade"}
-                )
-                df_vendas["quantidade"] = pd.to_numeric(df_vendas["quantidade"], errors="coerce").fillna(0)
-                df_vendas = df_vendas.groupby("codigo", as_index=False)["quantidade"].sum()
                 df_vendas = df_vendas[df_vendas["quantidade"] > 0]
 
                 st.subheader("📊 Vendas consolidadas por código")
@@ -516,6 +853,12 @@ else:
                     if falta > 0:
                         processar_codigo(cod, falta)
 
+                insumos_perfil = {
+                    "semis": len(semis_dict),
+                    "golas": len(golas_dict),
+                    "bordados": len(bordados_dict),
+                }
+
                 if erros_codigos:
                     st.warning(
                         "⚠ Alguns códigos das vendas não foram encontrados no template_estoque "
@@ -662,3 +1005,35 @@ else:
 
         except Exception as e:
             st.error(f"Ocorreu um erro ao processar as vendas: {e}")
+        finally:
+            if perfil is not None:
+                parar_perfil(perfil)
+                try:
+                    if REPLAY_PERFIL:
+                        salvar_perfil(perfil, REPLAY_PERFIL, nome="perfil_replay")
+                        st.caption(f"🔬 Perfil do replay salvo em `{REPLAY_PERFIL}`.")
+                        if meta_replay.get("insumos") and meta_replay["insumos"] != insumos_perfil:
+                            st.warning(
+                                "⚠ O replay não reproduziu a rodada original: insumos "
+                                f"{insumos_perfil} × original {meta_replay['insumos']}."
+                            )
+                    else:
+                        st.session_state["perfil_zip"] = gerar_pacote_perfil(
+                            perfil,
+                            st.session_state["df_estoque"],
+                            st.session_state.get("colunas_opcionais_adicionadas", []),
+                            uploaded_vendas,
+                            modo_blocos,
+                            insumos_perfil,
+                        )
+                except Exception as e:
+                    st.warning(f"Não foi possível gerar o perfil de desempenho: {e}")
+
+        if perfil_ativo and st.session_state.get("perfil_zip"):
+            nome_zip, dados_zip = st.session_state["perfil_zip"]
+            st.download_button(
+                "🔬 Baixar perfil + pacote de replay anonimizado (.zip)",
+                data=dados_zip,
+                file_name=nome_zip,
+                mime="application/zip",
+            )